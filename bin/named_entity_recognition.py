@@ -109,7 +109,7 @@
 #
 # First we import what we need from the library:
 
-# In[1]:
+# In[ ]:
 
 
 from bs4 import BeautifulSoup
@@ -117,20 +117,20 @@ from bs4 import BeautifulSoup
 
 # Then we open the letter using the `open()` function and pass the file into `BeautifulSoup`. This is jokingly called "making the soup".
 
-# In[6]:
+# In[ ]:
 
 
 with open("../data/henslow/letters_152.xml", encoding="utf-8") as file:
     letter = BeautifulSoup(file, "lxml-xml")
 
 
-# The letter has been opened, parsed by `BeautifulSoup` and stored with the name `letter`. Print out the text of the letter below to check the XML is what you expect.
+# The letter has been opened, parsed by `BeautifulSoup` and stored with the name `letter`. Print out the text of the letter below to check the XML is what you expect. The whole letter is rather long, and printing large amounts of text can make Jupyter slow to respond, so here we only print the first 500 characters with `str(letter)[:500]`. We will do the same whenever we print a transcription below.
 
-# In[7]:
+# In[ ]:
 
 
 # Your code here
-letter
+print(str(letter)[:500])
 
 
 # When we inspected the XML before, we saw that the actual content of Christy's letter is in the `<div>` element with the attribute `type` that has the value `"transcription"`.
@@ -141,13 +141,13 @@ letter
 #
 # Feel free to experiment and find out what happens if you miss off the attribute `text`.
 
-# In[13]:
+# In[ ]:
 
 
 transcription = letter.find(type="transcription").text
 # transcription = letter.find(type='transcription')
 
-print(transcription)
+print(transcription[:500])
 print(len(transcription))
 
 
@@ -159,20 +159,38 @@ print(len(transcription))
 # Your code here
 
 
+# ### A Faster Alternative: lxml and XPath
+#
+# Beautiful Soup is easy to use, but it searches the document with Python code, which becomes slow when we have hundreds of letters to get through. Beautiful Soup is itself using a faster library called [lxml](https://lxml.de/) to read the XML, and we can use lxml directly.
+#
+# lxml understands **XPath**, a language for selecting parts of an XML document. The expression `//*[@type="transcription"]//text()` means "all the text inside any element whose `type` attribute is `"transcription"`". We compile the expression once with `etree.XPath()` and can then apply it to as many letters as we like. It gives us the same words as Beautiful Soup did. The length is a little different, because lxml keeps all the spaces and line breaks that lay out the XML file, whereas Beautiful Soup shrinks each run of them to a single space or line break. So that the rest of this notebook carries on with the Beautiful Soup text, we store the lxml result under a different name, `xpath_transcription`:
+
+# In[ ]:
+
+
+from lxml import etree
+
+transcription_text = etree.XPath('//*[@type="transcription"]//text()')
+
+tree = etree.parse("../data/henslow/letters_152.xml")
+xpath_transcription = "".join(transcription_text(tree))
+print(len(xpath_transcription))
+
+
 # ### Cleaning the Transcription
 #
 # One small point of cleaning we will do now will make a big difference to the quality of NER later on. The style of writing in these letters is to replace the word 'and' with the ampersand (`&`). Experience tells me that spaCy's language model doesn't handle this very well because it is different in style to the texts it was trained on.
 
-# In[14]:
+# In[ ]:
 
 
 transcription = transcription.replace("& ", "and ")
 
 
-# In[15]:
+# In[ ]:
 
 
-transcription
+print(transcription[:500])
 
 
 # Ideally, we would instead re-train the language model to better understand the use of ampersands. In this notebook, I just want to show you a good example.
@@ -192,19 +210,49 @@ transcription
 #
 # A full list of the [available pre-trained language models](https://spacy.io/usage/models#languages) is available.
 #
+# The size of a model is a trade-off between speed and accuracy. The larger `'md'` and `'lg'` models include word vectors and are a little more accurate, but they take longer to load and to process each text. The `'sm'` model is the fastest of the three on an ordinary laptop, which makes it a good choice for running NER over a large collection of letters.
+#
 # To start, we import and load the pre-trained English language model and give it the name `nlp`, ready to do the work on the transcription. (The name could be anything, but `nlp` is used by convention, and you will see this name used in examples and tutorials.)
+#
+# We are only interested in named entities, so we `disable` the parts of the model that do other tasks. We will see what these parts are, and why switching them off makes spaCy faster, a little further on.
+#
+# Loading the model takes a few seconds, which adds up when you re-run the notebook while experimenting. So we wrap it in a small function, `get_nlp()`, and put `@functools.lru_cache` above it. This tells Python to remember what the function returns: if we call it again, for example by re-running the cell below that calls `get_nlp()`, Python hands back the model it has already loaded instead of reading it from disk again.
+
+# In[ ]:
 
-# In[16]:
 
+import functools
 
 import en_core_web_sm
 
-nlp = en_core_web_sm.load()
+
+@functools.lru_cache(maxsize=1)
+def get_nlp(disable=()):
+    """Load en_core_web_sm, reusing the loaded model on later calls."""
+    return en_core_web_sm.load(disable=list(disable))
+
+
+# If your computer has a graphics card (GPU) that supports CUDA and you have installed spaCy with GPU support, spaCy can run the model on the GPU, which is much faster when processing lots of letters. `spacy.prefer_gpu()` switches to the GPU if one is available and tells us whether it did; otherwise spaCy carries on using the CPU. This has to happen *before* the model is loaded.
+
+# In[ ]:
+
+
+import spacy
+
+using_gpu = spacy.prefer_gpu()
+if using_gpu:
+    print("Using GPU")
+
+
+# In[ ]:
+
+
+nlp = get_nlp(disable=("tagger", "parser"))
 
 
 # Before we go any further, let's take a moment to examine the metadata of this language model, and remind ourselves of what it consists. We can do this with the `meta` attribute:
 
-# In[17]:
+# In[ ]:
 
 
 nlp.meta
@@ -214,7 +262,7 @@ nlp.meta
 #
 # If you have forgotten already what a label stands for (some of them are rather cryptic!) then you can ask spaCy to give you a human-readable explanation:
 
-# In[18]:
+# In[ ]:
 
 
 import spacy
@@ -222,7 +270,7 @@ import spacy
 spacy.explain("FAC")
 
 
-# Note also the `'accuracy'` statistics, for your interest. The ones relevant to us are:
+# Note also the `'accuracy'` statistics, for your interest. We can look these up directly by their key in the metadata dictionary, `nlp.meta["accuracy"]`. The ones relevant to us are:
 #
 # `'ents_f': 85.5515654809,
 #  'ents_p': 85.8937524646,
@@ -240,14 +288,14 @@ spacy.explain("FAC")
 #
 # Now, we can pass the transcription into the language model and spaCy does the rest. It returns to us a `Doc` object (which we name `document`) that contains all the **tokens** and **annotations** it has created. We print out the document text stored on the attribute `text` just to check that spaCy has correctly parsed the transcription.
 
-# In[19]:
+# In[ ]:
 
 
 document = nlp(transcription)
-document.text
+print(document.text[:500])
 
 
-# But what has actually happened? Behind the scenes spaCy has done the following tasks:
+# But what has actually happened? Behind the scenes the full spaCy model can do the following tasks:
 #
 # * tokenizing and lemmatizing
 # * part-of-speech tagging ('tagger')
@@ -260,61 +308,69 @@ document.text
 #
 # Of all these components (tasks), the tokenizer is essential and must happen for every pipeline; the rest are optional, depending on what you want to do with your text.
 #
-# In the metadata for this model (`nlp.meta` above), you can see listed the pipeline components:
+# In the metadata for the full model (loaded with `en_core_web_sm.load()` and no components disabled), you can see listed the pipeline components:
 #
 # `'pipeline': ['tagger', 'parser', 'ner']`
 #
 # This is the default processing pipeline included with the `'en_core_web_sm'` language model. You can read more about [spaCy Processing Pipelines](https://spacy.io/usage/processing-pipelines).
 #
-# As we only need the `'ner'` component, we could speed up our code by disabling the tagger and the parser like this:
+# As we only need the `'ner'` component, we sped up our code by disabling the tagger and the parser when we loaded the model:
 #
 # `nlp = en_core_web_sm.load(disable=['tagger', 'parser'])`
+#
+# You can check which components are still switched on with `nlp.pipe_names`.
 
 # In[ ]:
 
 
 # Write your code here to compare the performance of the model with and without the unnecessary components
-# Hint: you could use the Jupyter magic command `%%time` or `import time` and use `time.time()`
+# Hint: load the full model with `en_core_web_sm.load()` and use the Jupyter magic command `%%time` or `import time` and use `time.time()`
 
 
-# Now, we just need to inspect the data. All the named entities are available on the `ents` attribute. The following code loops over all the named entities and prints each of them out with the labels that spaCy has predicted.
+# Now, we just need to inspect the data. All the named entities are available on the `ents` attribute. The following code loops over all the named entities and puts each of them on its own line with the label that spaCy has predicted. We `join` the lines together and print them all at once, which is quicker for Jupyter to display than printing each entity separately.
 
-# In[20]:
+# In[ ]:
 
 
-for entity in document.ents:
-    print(f"{entity.text}: {entity.label_}")
+print("\n".join(f"{entity.text}: {entity.label_}" for entity in document.ents))
 
 
 # What do you think of the accuracy of the labelling?
 
 # ### Exporting Named Entities in JSON Format
 # We can export these named entities in a JSON format, which can be saved in a file or used as input to other spaCy functions.
+#
+# spaCy can give us a dictionary of *all* the document data with `document.to_json()`, but that includes every single token in the letter. As we only want the named entities, it is quicker to build the list ourselves from `document.ents`, recording where each entity starts and ends in the text and its label. This is the same format `to_json()` uses for its `'ents'` item, so if you do need the full dictionary for something else you can pick the entities straight out of it by their key, `document.to_json()["ents"]`, without looping over all the other items.
+#
+# To turn the dictionary into JSON we use [orjson](https://github.com/ijl/orjson), which does the same job as Python's built-in `json` module but much faster. Note that `orjson.dumps()` gives back `bytes` rather than a string, ready to be written straight to a file.
 
-# In[21]:
+# In[ ]:
 
 
-# Create a dictionary form of the document data
-doc_dict = document.to_json()
-doc_dict
+# Collect the character offsets and label of each named entity
+ents_list = [
+    {"start": entity.start_char, "end": entity.end_char, "label": entity.label_}
+    for entity in document.ents
+]
+ents_list
 
 
-# In[22]:
+# In[ ]:
 
 
-# Get just the named entities item
-ents_dict = {key: value for (key, value) in doc_dict.items() if key == "ents"}
+# Put the named entities in a dictionary under the key "ents"
+ents_dict = {"ents": ents_list}
 ents_dict
 
 
-# In[23]:
+# In[ ]:
 
 
-# Import a module for handling json
-import json
+# Import a fast module for handling json
+import orjson
 
 # Export the named entities dictionary in json format
-json.dumps(ents_dict)
+orjson.dumps(ents_dict)
 
 
 # ---
@@ -325,7 +381,7 @@ json.dumps(ents_dict)
 #
 # Fortunately, spaCy provides a nice visualiser called **displacy** that does this for us.
 
-# In[24]:
+# In[ ]:
 
 
 from spacy import displacy
@@ -340,9 +396,9 @@ displacy.render(document, style="ent")
 #
 #
 
-# We can also **save** the results of a visualisation as an HTML file to review later:
+# We can also **save** the results of a visualisation as an HTML file to review later. Setting `minify=True` removes the extra spaces and line breaks from the HTML, which makes the file smaller without changing how it looks:
 
-# In[25]:
+# In[ ]:
 
 
 # Import a module that helps with filepaths
@@ -356,11 +412,11 @@ document.user_data[
     "title"
 ] = "Letter from William Christy, Jr., to John Henslow, 26 February 1831"
 
-# Output the visualisation as HTML
-html = displacy.render(document, style="ent", jupyter=False, page=True)
-
-# Write the HTML to the output file
-output_file.open("w", encoding="utf-8").write(html)
+# Write the visualisation as HTML straight to the output file
+with output_file.open("w", encoding="utf-8") as file:
+    file.write(
+        displacy.render(document, style="ent", jupyter=False, page=True, minify=True)
+    )
 
 
 # Now navigate to the file in the Jupyter file listing, or click on this link to view the file: [`output/ent_viz.html`](output/ent_viz.html). (Note that this file will not exist until you have run the code above!)
@@ -372,6 +428,170 @@ output_file.open("w", encoding="utf-8").write(html)
 #
 # ---
 
+# ---
+# ---
+# ## Running NER on Many Letters
+#
+# So far we have passed one transcription at a time to `nlp()`. That is fine for a single letter, but when we want to process the whole collection it is much faster to hand spaCy a *stream* of texts with the **`nlp.pipe()`** method. spaCy then works through the texts in batches, and can spread the batches across several processes on your computer.
+#
+# First we write a **generator** function that opens each letter in turn, extracts and cleans the transcription, and `yield`s it. Instead of Beautiful Soup we use lxml's `iterparse()`, which reads through the XML one element at a time and lets us stop reading the file once we have found the `<div>` with `type="transcription"`. (In these letters the transcription comes after the long `<teiHeader>`, so most of the file has still been read by then.) A generator only does the work for each letter when spaCy asks for the next text, so we never need to hold all the parsed XML documents in memory at once.
+#
+# Rather than calling `replace()` once for each thing we want to tidy up, `clean_transcription()` uses a **regular expression** to find ampersands, non-breaking spaces and em dashes in a single pass over the text, and looks up what to replace each one with in the `REPLACEMENTS` dictionary, using the name of the group (`(?P<name>...)`) that matched. To clean up something else, add a named group to the pattern and its replacement to the dictionary. The same pass also shrinks each run of spaces and line breaks left over from the layout of the XML file to a single space, so spaCy sees ordinary text, much as Beautiful Soup gave us above.
+#
+# Parsing a thousand XML files takes a while, and you are likely to re-run these cells as you experiment. In the code below, `parse_transcription()` does the actual reading, and the `@functools.lru_cache` line above `read_transcription()` tells Python to remember the transcription it returns for each letter, just as we did for `get_nlp()`. We also pass in the time the file was last modified (`os.path.getmtime()`), so if a letter is edited it will be parsed afresh.
+#
+# The cache keeps the text of every transcription in memory (a few megabytes for this collection) for as long as the notebook is running. What it buys us is that re-running the `nlp.pipe()` cell below does not parse all the letters again. The cache is emptied if you re-run the cell that defines `read_transcription()`, and the separate processes we start with joblib further down do not use it.
+
+# In[ ]:
+
+
+import functools
+import os
+import re
+
+from lxml import etree
+
+# Ampersands followed by whitespace, em dashes (one or several, with any spaces
+# around them), and non-breaking spaces or runs of whitespace from the XML layout
+CLEAN_PATTERN = re.compile(
+    r"(?P<ampersand>&(?=\s))|(?P<dash>\s*(?:\u2014\s*)+)|(?P<space>\s{2,}|\u00a0)"
+)
+REPLACEMENTS = {"ampersand": "and", "dash": " - ", "space": " "}
+
+
+def clean_transcription(text):
+    """Replace every match of CLEAN_PATTERN in a single pass over text."""
+    return CLEAN_PATTERN.sub(lambda match: REPLACEMENTS[match.lastgroup], text)
+
+
+def parse_transcription(path):
+    """Return the cleaned transcription of the letter at path."""
+    with open(path, "rb") as file:
+        for _, element in etree.iterparse(file, tag="{*}div"):
+            if element.get("type") == "transcription":
+                text = "".join(element.itertext())
+                element.clear()
+                return clean_transcription(text).strip()
+
+
+@functools.lru_cache(maxsize=None)
+def read_transcription(path, mtime):
+    """Return parse_transcription(path), remembered for each modification time.
+
+    A letter is only parsed again if the file has changed.
+    """
+    return parse_transcription(path)
+
+
+def iter_transcriptions(paths):
+    """Yield the cleaned transcription of each letter in paths."""
+    for path in paths:
+        yield read_transcription(path, os.path.getmtime(path))
+
+
+# Now we collect the paths of all the letters and pass the generator to `nlp.pipe()`. The `batch_size` is the number of letters spaCy processes together and `n_process` is the number of processes to use; here we leave one CPU free for the rest of the computer. If we are using a GPU, we instead send it bigger batches from a single process, because a GPU works fastest when it has lots of letters to process at once.
+
+# In[ ]:
+
+
+paths = sorted(Path("../data/henslow").glob("letters_*.xml"))
+
+docs = list(
+    nlp.pipe(
+        iter_transcriptions(paths),
+        batch_size=256 if using_gpu else 64,
+        n_process=1 if using_gpu else max(1, os.cpu_count() - 1),
+    )
+)
+len(docs)
+
+
+# ---
+# > **EXERCISE**: Try a few different values for `batch_size` between 32 and 128 and time each run with `%%time`. Which value is fastest on your computer?
+#
+# ---
+
+# `displacy.render()` also accepts a list of documents, so we can save the visualisations of several letters in a single HTML page. Here we give each document the name of its file as a title and save the first ten letters:
+
+# In[ ]:
+
+
+for path, doc in zip(paths, docs):
+    doc.user_data["title"] = path.name
+
+with Path("../results/ent_viz_letters.html").open("w", encoding="utf-8") as file:
+    file.write(
+        displacy.render(docs[:10], style="ent", jupyter=False, page=True, minify=True)
+    )
+
+
+# ### Sharing the Work Between Processes
+#
+# When we use `n_process`, spaCy sends every finished `Doc` back to the notebook, including all of its tokens. If all we want is the list of named entities, it is quicker to split the letters into one **shard** per CPU and let each process load its own copy of the model, run the NER on its shard and send back only the entities. The [joblib](https://joblib.readthedocs.io/) library makes this straightforward.
+#
+# Note that we make only as many shards as there are CPUs: splitting the letters into lots of small pieces would mean loading the model many more times than we need to.
+#
+# joblib has to send our functions to each new process. It cannot send functions wrapped in `@functools.lru_cache`, such as `get_nlp()` and `read_transcription()`, and a new process would start with an empty cache anyway. So `find_entities()` loads the model with `en_core_web_sm.load()` and reads each letter with the plain `parse_transcription()` function.
+#
+# Inside each process, `entity_spans()` avoids asking spaCy for a `Span` object for every entity with `document.ents`, or for the `Token` objects inside it. Instead, a single call to `doc.to_array()` gives us a table (a NumPy array) with one row per token, recording whether the token begins an entity, is inside one or is outside any entity, the entity's label, the length of the token and whether a space follows it. From it we can work out where every entity starts and ends in the text in one go; the only Python objects left to create are the small dictionaries we export, in the same format as for a single letter above.
+
+# In[ ]:
+
+
+import numpy
+from joblib import Parallel, delayed
+from spacy.attrs import ENT_IOB, ENT_TYPE, LENGTH, SPACY
+
+# ENT_IOB values for the first token of an entity and the tokens after it
+BEGIN, INSIDE = 3, 1
+
+
+def entity_spans(doc):
+    """Return the character offsets and label of every entity in doc."""
+    iob, labels, lengths, spaces = doc.to_array([ENT_IOB, ENT_TYPE, LENGTH, SPACY]).T
+    # Each token starts where the text and trailing spaces of those before it end
+    token_starts = numpy.cumsum(lengths + spaces) - lengths - spaces
+    starts = numpy.flatnonzero(iob == BEGIN)
+    # An entity ends at the first token after its start that is not INSIDE it
+    boundaries = numpy.append(numpy.flatnonzero(iob != INSIDE), len(doc))
+    ends = boundaries[numpy.searchsorted(boundaries, starts, side="right")] - 1
+    return [
+        {"start": start, "end": end, "label": doc.vocab.strings[label]}
+        for start, end, label in zip(
+            token_starts[starts].tolist(),
+            (token_starts[ends] + lengths[ends]).tolist(),
+            labels[starts].tolist(),
+        )
+    ]
+
+
+def find_entities(paths):
+    """Return each path with the offsets and label of every entity in its letter."""
+    nlp = en_core_web_sm.load(disable=["tagger", "parser"])
+    transcriptions = (parse_transcription(path) for path in paths)
+    docs = nlp.pipe(transcriptions, batch_size=64)
+    return [(path, entity_spans(doc)) for path, doc in zip(paths, docs)]
+
+
+n_jobs = os.cpu_count()
+shard_size = -(-len(paths) // n_jobs)  # round up so no letters are left over
+shards = [paths[i : i + shard_size] for i in range(0, len(paths), shard_size)]
+
+results = Parallel(n_jobs=n_jobs)(delayed(find_entities)(shard) for shard in shards)
+entities = [letter for shard in results for letter in shard]
+entities[0]
+
+
+# Finally, we can export the named entities of every letter to a single JSON file, with the file name of each letter as its key. Each letter's entities are stored under `"ents"`, just like `ents_dict` above, so they can be used as input to other spaCy functions in the same way:
+
+# In[ ]:
+
+
+Path("../results/entities.json").write_bytes(
+    orjson.dumps({path.name: {"ents": ents_list} for path, ents_list in entities})
+)
+
+
 # ---
 # ---
 # ## Summary
@@ -380,9 +600,11 @@ output_file.open("w", encoding="utf-8").write(html)
 #
 # - A **named entity** is defined as any type of real-world object or concept that is assigned a name or proper name.
 # - The Python library **BeautifulSoup** can parse text in XML, which is useful for extracting the text of Henslow letters marked up in TEI.
+# - The Python library **lxml** can do the same job faster, using **XPath** expressions or by streaming through the XML with `iterparse()`.
 # - The Python library **spaCy** can predict named entities by using an English language model that has been pre-trained using machine learning on a corpus of general modern texts.
 # - spaCy can recognise certain **pre-defined** named entities 'out of the box'.
 # - The **predictions** made by spaCy's default model are quite good but suffer from some inaccuracies.
 # - spaCy can **visualise** the named entity labels within the context of the original text so we can better assess the accuracy of the predictions.
+# - spaCy's **`nlp.pipe()`** method processes many texts in batches, which is much faster than calling `nlp()` on each letter in turn.
 #
 # In the [next notebook](3-principles-of-machine-learning-for-named-entities.ipynb) we will look in more detail at how machine learning **models** make **predictions** about named entities, how to improve the predictions by **training** the model and how to create **training data** by labelling data manually.